@@ -7,6 +7,7 @@ class User(BaseModel):
     name: str
     date_joined: Optional[str] = None
     friends: List[str] = []
+    friends_updated: Optional[str] = None
 
 class UserUpdate(BaseModel):
     name: Optional[str] = None
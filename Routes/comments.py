@@ -1,8 +1,13 @@
-from fastapi import APIRouter, Body, HTTPException, Depends
+from fastapi import APIRouter, Body, HTTPException, Depends, Request, Response
 from Modules import Comment
 from firebase_admin import db
 
 from auth import get_current_user
+import changelog
+import etags
+import upstream
+import cache
+import batcher
 
 import datetime
 
@@ -14,29 +19,41 @@ router = APIRouter(
 # -------------------- COMMENT METHODS --------------------
 @router.post("", response_model=Comment)
 def create_comment(comment: Comment = Body(...), _: str = Depends(get_current_user)):
-    ref = db.reference(f"Comments")
-    new_ref = ref.push()
-    new_id = new_ref.key
+    if batcher.ENABLED:
+        new_id = batcher.new_key()
+    else:
+        new_id = upstream.firebase.call(db.reference(f"Comments").push).key
 
     comment_dict = comment.model_dump()
     comment_dict["id"] = new_id
     comment_dict["date_created"] = datetime.datetime.now().isoformat()
 
-    new_ref.set(comment_dict)
-    song_to_comment(comment_dict["song_id"], new_id)
+    updates = {f"Comments/{new_id}": comment_dict}
+    updates.update(song_to_comment(comment_dict["song_id"], new_id))
+    updates.update(etags.version_entry(f"SongToComments/{comment_dict['song_id']}"))
+    playlist_id = changelog.playlist_of_song(comment_dict["song_id"])
+    if playlist_id:
+        updates.update(changelog.change_entry(playlist_id, changelog.COMMENT_ADDED, new_id, comment_dict))
+    batcher.commit(updates)
     return comment_dict
 
 
 def song_to_comment(song_id: str, comment_id: str):
-    ref = db.reference(f"SongToComments/{song_id}")
-    ref.update({comment_id: True})
-    return "Successful mapping Song to Comment."
+    '''Returns the multi-path update entry mapping Song to Comment.'''
+    return {f"SongToComments/{song_id}/{comment_id}": True}
 
 
 @router.get("/{comment_id}", response_model=Comment)
-def get_comment(comment_id: str, _: str = Depends(get_current_user)):
+def get_comment(
+    comment_id: str,
+    request: Request = None,
+    response: Response = None,
+    _: str = Depends(get_current_user)
+):
     ref = db.reference(f"Comments/{comment_id}")
-    data = ref.get()
+    data, unchanged = etags.read_entity(ref, request, response)
+    if unchanged:
+        return unchanged
     if not data:
         raise HTTPException(status_code=404, detail="Comment not found")
     data["id"] = comment_id
@@ -52,41 +69,57 @@ def update_comment(
     com_dict["id"] = comment_id
     com_dict["text"] = updated_text
     com_dict["edited"] = True
-    ref = db.reference(f"Comments/{comment_id}")
-    existing = ref.get()
 
-    if not existing:
-        raise HTTPException(status_code=404, detail="Comment not found")
-    
-    ref.update(com_dict)
-    
-    updated_data = ref.get()
-    return Comment(**updated_data)
+    updates = {f"Comments/{comment_id}/{key}": value for key, value in com_dict.items()}
+    updates.update(etags.version_entry(f"SongToComments/{com_dict['song_id']}"))
+    playlist_id = changelog.playlist_of_song(com_dict["song_id"])
+    if playlist_id:
+        updates.update(changelog.change_entry(playlist_id, changelog.COMMENT_EDITED, comment_id, com_dict))
+    upstream.db_update(updates)
+
+    return Comment(**com_dict)
 
 @router.delete("/{comment_id}")
 def delete_comment(comment_id: str, _: str = Depends(get_current_user)):
     ref = db.reference(f"Comments/{comment_id}")
-    data = ref.get()
+    data = upstream.firebase.call(ref.get)
 
     if not data:
         raise HTTPException(status_code=404, detail="Comment not found")
-    
-    ref.delete()
-    remove_comment_map(comment_id)
+
+    updates = {f"Comments/{comment_id}": None}
+    updates.update(remove_comment_map(data["song_id"], comment_id))
+    updates.update(etags.version_entry(f"SongToComments/{data['song_id']}"))
+    playlist_id = changelog.playlist_of_song(data["song_id"])
+    if playlist_id:
+        updates.update(changelog.change_entry(playlist_id, changelog.COMMENT_DELETED, comment_id))
+    upstream.db_update(updates)
     return {"message": f"Comment {comment_id} deleted successfully"}
 
-def remove_comment_map(comment_id: str):
-    ref = db.reference(f"SongToComments/{comment_id}")
-    data = ref.get()
-    if not data:
+def remove_comment_map(song_id: str, comment_id: str):
+    '''Returns the multi-path update entry removing comment from SongToComments mapping.'''
+    if not upstream.db_get(f"SongToComments/{song_id}/{comment_id}"):
         raise HTTPException(status_code=404, detail="Comment not found in Song to Comments mapping")
-    ref.delete()
+    return {f"SongToComments/{song_id}/{comment_id}": None}
 
 
 @router.get("/{song_id}/comments")
-def get_all_comments_for(song_id: str, _: str = Depends(get_current_user)):
-    ref = db.reference(f"SongToComments/{song_id}")
-    data = ref.get()
+def get_all_comments_for(
+    song_id: str,
+    request: Request = None,
+    response: Response = None,
+    _: str = Depends(get_current_user)
+):
+    unchanged = etags.check_collection(f"SongToComments/{song_id}", request, response)
+    if unchanged:
+        return unchanged
+
+    # everyone opening the same song thread at once shares one fetch
+    return cache.versioned(f"SongToComments/{song_id}", lambda: load_comments_for(song_id))
+
+
+def load_comments_for(song_id: str):
+    data = upstream.db_get(f"SongToComments/{song_id}")
     all_comments = []
 
     if data == None:
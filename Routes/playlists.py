@@ -1,10 +1,18 @@
-from fastapi import APIRouter, Body, HTTPException, Depends
+from fastapi import APIRouter, Body, HTTPException, Depends, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from Modules import Playlist, PlaylistUpdate
 from Modules.Invitation import Invitation
 from firebase_admin import db
 import uuid
+import json
 from datetime import datetime, timedelta, timezone
 from auth import get_current_user
+import changelog
+import etags
+import upstream
+import cache
+import transfer
 
 router = APIRouter(
     prefix="/playlist",
@@ -15,7 +23,7 @@ router = APIRouter(
 @router.post("", response_model=Playlist)
 def create_playlist(playlist: Playlist = Body(...), uid: str = Depends(get_current_user)):
     ref = db.reference(f"Playlists")
-    new_ref = ref.push()
+    new_ref = upstream.firebase.call(ref.push)
     new_id = new_ref.key
 
     playlist_dict = playlist.model_dump()
@@ -26,21 +34,29 @@ def create_playlist(playlist: Playlist = Body(...), uid: str = Depends(get_curre
     playlist_dict["date_created"] = datetime.now().isoformat()
     playlist_dict["last_updated"] = datetime.now().isoformat()
 
-    new_ref.set(playlist_dict)
-    us_to_pl(owner, new_id)
+    updates = {f"Playlists/{new_id}": playlist_dict}
+    updates.update(us_to_pl(owner, new_id))
+    updates.update(etags.version_entry(f"UserToPlaylists/{owner}"))
+    upstream.db_update(updates)
     
     return playlist_dict
 
 def us_to_pl(user_id: str, playlist_id: str):
-    ref = db.reference(f"UserToPlaylists/{user_id}")
-    ref.update({playlist_id: True})
-    return "Successful mapping User to Playlist."
+    '''Returns the multi-path update entry mapping User to Playlist.'''
+    return {f"UserToPlaylists/{user_id}/{playlist_id}": True}
 
 
 @router.get("/{playlist_id}", response_model=Playlist)
-def get_playlist(playlist_id: str, _: str = Depends(get_current_user)):
+def get_playlist(
+    playlist_id: str,
+    request: Request = None,
+    response: Response = None,
+    _: str = Depends(get_current_user)
+):
     ref = db.reference(f"Playlists/{playlist_id}")
-    data = ref.get()
+    data, unchanged = etags.read_entity(ref, request, response)
+    if unchanged:
+        return unchanged
     if not data:
         raise HTTPException(status_code=404, detail="Playlist not found")
     data["id"] = playlist_id
@@ -53,68 +69,100 @@ def patch_playlist(playlist_id: str, update: PlaylistUpdate = Body(...), _: str
     update_dict = update.model_dump(exclude_unset=True)
 
     ref = db.reference(f"Playlists/{playlist_id}")
-    existing = ref.get()
+    existing = upstream.firebase.call(ref.get)
 
     if not existing:
         raise HTTPException(status_code=404, detail="Playlist not found")
     
     print(update_dict)
 
+    extra_updates = {}
+
     # Merge editors if provided
     if "new_editor" in update_dict:
-        new_editor_id = update_dict["new_editor"]
+        new_editor_id = update_dict.pop("new_editor")
         if new_editor_id not in existing["editors"]:
             existing["editors"].append(new_editor_id)
             update_dict["editors"] = existing["editors"]
             print("Combined editors", update_dict["editors"])
-            us_to_pl(new_editor_id, playlist_id)            # if there is a new editor create user to pl entry
+            # if there is a new editor create user to pl entry and log it
+            extra_updates.update(us_to_pl(new_editor_id, playlist_id))
+            extra_updates.update(changelog.change_entry(playlist_id, changelog.EDITOR_ADDED, new_editor_id))
 
     # Always update id and timestamp server-side
     update_dict["id"] = playlist_id
     update_dict["last_updated"] = datetime.now().isoformat()
 
-    # Update only specified fields
-    ref.update(update_dict)
-
-    updated_data = ref.get()
-    return Playlist(**updated_data)
-
-
-def remove_pl_from(user_id: str, playlist_id: str):
-    '''Removes playlist mapping from UserToPlaylists relationship.'''
-    ref = db.reference(f"UserToPlaylists/{user_id}/{playlist_id}")
-    data = ref.get()
-    if not data:
-        raise HTTPException(status_code=404, detail="Playlist not found in User to Playlist mapping")
-    ref.delete()
+    # Update only specified fields, together with mappings and change log
+    updates = {f"Playlists/{playlist_id}/{key}": value for key, value in update_dict.items()}
+    updates.update(extra_updates)
+    # playlist lists of every editor now hold a stale copy
+    for editor in existing["editors"]:
+        updates.update(etags.version_entry(f"UserToPlaylists/{editor}"))
+    upstream.db_update(updates)
 
-def remove_pl_map(playlist_id: str):
-    '''Removes playlist mapping from PlaylistToSongs relationship.'''
-    ref = db.reference(f"PlaylistToSongs/{playlist_id}")
-    data = ref.get()
-    if not data:
-        raise HTTPException(status_code=404, detail="Playlist not found in Playlist to Song mapping")
-    ref.delete()
+    existing.update(update_dict)
+    return Playlist(**existing)
 
 
 @router.delete("/{playlist_id}")
 def delete_playlist(playlist_id: str, _: str = Depends(get_current_user)):
     ref = db.reference(f"Playlists/{playlist_id}")
-    data = ref.get()
+    data = upstream.firebase.call(ref.get)
     if not data:
         raise HTTPException(status_code=404, detail="Playlist not found")
-    
-    ref.delete()
 
-    for editor in data["editors"]: remove_pl_from(editor, playlist_id)
-    remove_pl_map(playlist_id)
+    # one multi-path update, so a playlist is never left half deleted
+    updates = {
+        f"Playlists/{playlist_id}": None,
+        f"PlaylistToSongs/{playlist_id}": None,
+        f"PlaylistChanges/{playlist_id}": None,
+        # without a stamp the song list is neither cached nor answered with 304 anymore
+        f"Versions/PlaylistToSongs/{playlist_id}": None,
+    }
+    for editor in data["editors"]:
+        updates[f"UserToPlaylists/{editor}/{playlist_id}"] = None
+        updates.update(etags.version_entry(f"UserToPlaylists/{editor}"))
+    upstream.db_update(updates)
     return {"message": f"Playlist {playlist_id} deleted successfully"}
 
 
+@router.get("/{playlist_id}/changes")
+def get_playlist_changes(
+    playlist_id: str,
+    since: str = Query(None),
+    _: str = Depends(get_current_user)
+):
+    '''
+    Returns changes made to the playlist after the `since` cursor.
+
+    since: str, cursor returned by the previous call. Omit it to get the current cursor.
+    If "reset" is true the client should refetch the playlist in full and continue from "cursor".
+    Answers 404 once the playlist is deleted, so syncing clients learn it is gone.
+    '''
+    if not upstream.db_get(f"Playlists/{playlist_id}/owner"):
+        raise HTTPException(status_code=404, detail="Playlist not found")
+
+    changelog.maybe_compact(playlist_id)
+    return changelog.get_changes_since(playlist_id, since)
+
+
 @router.get("/{user_id}/playlists")
-def get_all_playlists_for(user_id: str, _: str = Depends(get_current_user)):
-    ref = db.reference(f"UserToPlaylists/{user_id}")
-    data = ref.get()
+def get_all_playlists_for(
+    user_id: str,
+    request: Request = None,
+    response: Response = None,
+    _: str = Depends(get_current_user)
+):
+    unchanged = etags.check_collection(f"UserToPlaylists/{user_id}", request, response)
+    if unchanged:
+        return unchanged
+
+    return cache.versioned(f"UserToPlaylists/{user_id}", lambda: load_playlists_for(user_id))
+
+
+def load_playlists_for(user_id: str):
+    data = upstream.db_get(f"UserToPlaylists/{user_id}")
     all_playlists = []
     
     if data == None:
@@ -128,12 +176,71 @@ def get_all_playlists_for(user_id: str, _: str = Depends(get_current_user)):
 
     return all_playlists
 
+# ---Export / import methods---
+
+@router.get("/{playlist_id}/export")
+def export_playlist(playlist_id: str, _: str = Depends(get_current_user)):
+    '''
+    Streams the playlist with its songs, comments and reactions as NDJSON,
+    reading the database page by page while the response is being sent.
+    '''
+    playlist = get_playlist(playlist_id).model_dump()
+    return StreamingResponse(
+        transfer.export_ndjson(playlist_id, playlist),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="playlist-{playlist_id}.ndjson"'}
+    )
+
+
+@router.post("/import")
+async def import_playlist(request: Request, name: str = Query(None), uid: str = Depends(get_current_user)):
+    '''
+    Creates a new playlist owned by the caller from an NDJSON export sent as request body.
+    All ids are replaced with new ones; records are written in bounded batches as they arrive.
+
+    name: str, optional name for the new playlist, defaults to the exported one
+    '''
+    importer = transfer.PlaylistImporter(uid, name)
+    try:
+        async for line in transfer.ndjson_lines(request.stream()):
+            importer.add(json.loads(line))
+            if importer.ready():
+                await run_in_threadpool(importer.flush)
+        return await run_in_threadpool(importer.finish)
+    except Exception as e:
+        try:
+            await run_in_threadpool(importer.abort)
+        finally:
+            if isinstance(e, ValueError):
+                raise HTTPException(status_code=400, detail=f"Invalid export: {e}")
+            raise e
+
+
+@router.post("/{playlist_id}/duplicate")
+def duplicate_playlist(playlist_id: str, name: str = Query(None), uid: str = Depends(get_current_user)):
+    '''Copies the playlist with its songs, comments and reactions into a new playlist owned by the caller.'''
+    playlist = get_playlist(playlist_id).model_dump()
+    importer = transfer.PlaylistImporter(uid, name or f"{playlist['name']} (copy)")
+    try:
+        for record in transfer.export_records(playlist_id, playlist):
+            importer.add(record)
+            if importer.ready():
+                importer.flush()
+        return importer.finish()
+    except Exception as e:
+        try:
+            importer.abort()
+        finally:
+            if isinstance(e, ValueError):
+                raise HTTPException(status_code=400, detail=f"Playlist can't be copied: {e}")
+            raise e
+
 # ---Invitation to playlist methods---
 
 @router.post("/{playlist_id}/invites", response_model=Invitation)
 def create_invite(playlist_id: str, user_id: str, _: str = Depends(get_current_user)):
     playlist_ref = db.reference(f"Playlists/{playlist_id}")
-    playlist = playlist_ref.get()
+    playlist = upstream.firebase.call(playlist_ref.get)
 
     if not playlist:
         raise HTTPException(status_code=404, detail="Playlist not found")
@@ -154,14 +261,14 @@ def create_invite(playlist_id: str, user_id: str, _: str = Depends(get_current_u
         "expires_at": expires_at.isoformat()
     }
         
-    db.reference(f"Invites/{invite_id}").set(invitation)
+    upstream.firebase.call(db.reference(f"Invites/{invite_id}").set, invitation)
 
     return invitation
 
 @router.get("/invites/{invite_id}", response_model=Invitation)
 def validate_invite(invite_id: str, _: str = Depends(get_current_user)):
     invite_ref = db.reference(f"Invites/{invite_id}")
-    invite = invite_ref.get()
+    invite = upstream.firebase.call(invite_ref.get)
 
     if not invite:
         raise HTTPException(status_code=404, detail="Invalid invite")
@@ -177,7 +284,7 @@ def validate_invite(invite_id: str, _: str = Depends(get_current_user)):
 @router.post("/{playlist_id}/editors")
 def add_editor(playlist_id: str, user_id: str, _: str = Depends(get_current_user)):
     playlist_ref = db.reference(f"Playlists/{playlist_id}")
-    playlist = playlist_ref.get()
+    playlist = upstream.firebase.call(playlist_ref.get)
 
     if not playlist:
         raise HTTPException(status_code=404, detail="Playlist not found")
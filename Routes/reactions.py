@@ -1,7 +1,12 @@
-from fastapi import APIRouter, Body, HTTPException, Depends
+from fastapi import APIRouter, Body, HTTPException, Depends, Request, Response
 from Modules import Reaction
 from firebase_admin import db
 from auth import get_current_user
+import changelog
+import etags
+import upstream
+import cache
+import batcher
 
 router = APIRouter(
     prefix="/reaction",
@@ -12,26 +17,39 @@ router = APIRouter(
 # -------------------- REACTION METHODS --------------------
 @router.post("", response_model=Reaction)
 def create_reaction(reaction: Reaction = Body(...), _: str = Depends(get_current_user)):
-    ref = db.reference(f"Reactions")
-    new_ref = ref.push()
-    new_id = new_ref.key
+    if batcher.ENABLED:
+        new_id = batcher.new_key()
+    else:
+        new_id = upstream.firebase.call(db.reference(f"Reactions").push).key
 
     reaction_dict = reaction.model_dump()
     reaction_dict["id"] = new_id
-    new_ref.set(reaction_dict)
-    comment_to_reaction(reaction["comment_id"], new_id)
+
+    updates = {f"Reactions/{new_id}": reaction_dict}
+    updates.update(comment_to_reaction(reaction_dict["comment_id"], new_id))
+    updates.update(etags.version_entry(f"CommentToReactions/{reaction_dict['comment_id']}"))
+    playlist_id = changelog.playlist_of_comment(reaction_dict["comment_id"])
+    if playlist_id:
+        updates.update(changelog.change_entry(playlist_id, changelog.REACTION_ADDED, new_id, reaction_dict))
+    batcher.commit(updates)
     return reaction_dict
 
 def comment_to_reaction(comment_id: str, reaction_id: str):
-    ref = db.reference(f"CommentToReactions/{comment_id}")
-    ref.update({reaction_id: True})
-    return "Successful mapping Comment to Reactions."
+    '''Returns the multi-path update entry mapping Comment to Reaction.'''
+    return {f"CommentToReactions/{comment_id}/{reaction_id}": True}
 
 
 @router.get("/{reaction_id}", response_model=Reaction)
-def get_reaction(reaction_id: str, _: str = Depends(get_current_user)):
+def get_reaction(
+    reaction_id: str,
+    request: Request = None,
+    response: Response = None,
+    _: str = Depends(get_current_user)
+):
     ref = db.reference(f"Reactions/{reaction_id}")
-    data = ref.get()
+    data, unchanged = etags.read_entity(ref, request, response)
+    if unchanged:
+        return unchanged
     if not data:
         raise HTTPException(status_code=404, detail="Reaction not found")
     data["id"] = reaction_id
@@ -41,26 +59,47 @@ def get_reaction(reaction_id: str, _: str = Depends(get_current_user)):
 @router.delete("/{reaction_id}")
 def delete_reaction(reaction_id: str, _: str = Depends(get_current_user)):
     ref = db.reference(f"Reactions/{reaction_id}")
-    data = ref.get()
+    data = upstream.firebase.call(ref.get)
     if not data:
         raise HTTPException(status_code=404, detail="Reaction not found")
-    ref.delete()
-    remove_reaction_map(reaction_id)
+
+    updates = {f"Reactions/{reaction_id}": None}
+    updates.update(remove_reaction_map(data["comment_id"], reaction_id))
+    updates.update(etags.version_entry(f"CommentToReactions/{data['comment_id']}"))
+    playlist_id = changelog.playlist_of_comment(data["comment_id"])
+    if playlist_id:
+        updates.update(changelog.change_entry(playlist_id, changelog.REACTION_REMOVED, reaction_id, {"comment_id": data["comment_id"]}))
+    upstream.db_update(updates)
     return {"message": f"Reaction {reaction_id} deleted successfully"}
 
 
-def remove_reaction_map(reaction_id: str):
-    ref = db.reference(f"CommentToReactions/{reaction_id}")
-    data = ref.get()
-    if not data:
+def remove_reaction_map(comment_id: str, reaction_id: str):
+    '''Returns the multi-path update entry removing reaction from CommentToReactions mapping.'''
+    if not upstream.db_get(f"CommentToReactions/{comment_id}/{reaction_id}"):
         raise HTTPException(status_code=404, detail="Reaction not found in Comment to Reactions mapping")
-    ref.delete()
+    return {f"CommentToReactions/{comment_id}/{reaction_id}": None}
 
 @router.get("/{comment_id}/reactions")
-def get_all_reactions_for(comment_id: str, _: str = Depends(get_current_user)):
-    ref = db.reference(f"CommentToReactions/{comment_id}")
-    data = ref.get()
+def get_all_reactions_for(
+    comment_id: str,
+    request: Request = None,
+    response: Response = None,
+    _: str = Depends(get_current_user)
+):
+    unchanged = etags.check_collection(f"CommentToReactions/{comment_id}", request, response)
+    if unchanged:
+        return unchanged
+
+    return cache.versioned(f"CommentToReactions/{comment_id}", lambda: load_reactions_for(comment_id))
+
+
+def load_reactions_for(comment_id: str):
+    data = upstream.db_get(f"CommentToReactions/{comment_id}")
     all_reactions = []
+
+    if data == None:
+        return all_reactions
+
     for reaction_id in data:
         try: 
             all_reactions.append(get_reaction(reaction_id))
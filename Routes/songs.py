@@ -1,4 +1,4 @@
-from fastapi import APIRouter, HTTPException, Query, Depends
+from fastapi import APIRouter, HTTPException, Query, Depends, Request, Response
 from Modules import Song
 from firebase_admin import db
 
@@ -9,8 +9,13 @@ import re
 from dotenv import load_dotenv
 import os
 from googleapiclient.discovery import build
+import httplib2
 
 from auth import get_current_user
+import changelog
+import etags
+import upstream
+import cache
 
 router = APIRouter(
     prefix="/song",
@@ -36,7 +41,7 @@ def create_song(
     user_id: str, id of the user who added this song
     '''
     ref = db.reference(f"Songs")
-    new_ref = ref.push()
+    new_ref = upstream.firebase.call(ref.push)
     new_id = new_ref.key
 
     data = get_yt_data(url)
@@ -53,20 +58,31 @@ def create_song(
                     )
 
     song_dict = new_song.model_dump()
-    new_ref.set(song_dict)
-    pl_to_song(playlist_id, new_id)
+
+    # entity, mapping and change log entry go out in one multi-path update
+    updates = {f"Songs/{new_id}": song_dict}
+    updates.update(pl_to_song(playlist_id, new_id))
+    updates.update(changelog.change_entry(playlist_id, changelog.SONG_ADDED, new_id, song_dict))
+    updates.update(etags.version_entry(f"PlaylistToSongs/{playlist_id}"))
+    upstream.db_update(updates)
 
     return song_dict
 
 def pl_to_song(playlist_id: str, song_id: str):
-    ref = db.reference(f"PlaylistToSongs/{playlist_id}")
-    ref.update({song_id: True})
-    return
+    '''Returns the multi-path update entry mapping Playlist to Song.'''
+    return {f"PlaylistToSongs/{playlist_id}/{song_id}": True}
 
 @router.get("/{song_id}", response_model=Song)
-def get_song(song_id: str, _: str = Depends(get_current_user)):
+def get_song(
+    song_id: str,
+    request: Request = None,
+    response: Response = None,
+    _: str = Depends(get_current_user)
+):
     ref = db.reference(f"Songs/{song_id}")
-    data = ref.get()
+    data, unchanged = etags.read_entity(ref, request, response)
+    if unchanged:
+        return unchanged
     if not data:
         raise HTTPException(status_code=404, detail="Song not found")
     data["id"] = song_id
@@ -86,28 +102,44 @@ def get_song(song_id: str, _: str = Depends(get_current_user)):
 #     updated_data = ref.get()
 #     return Song(**updated_data)
 
-def remove_song_from(playlist_id: str, song_id: str):
-    ref = db.reference(f"PlaylistToSongs/{playlist_id}/{song_id}")
-    data = ref.get()
-    if not data:
-        raise HTTPException(status_code=404, detail="Song not found in mapping")
-    ref.delete()
-
 @router.delete("/{song_id}")
 def delete_song(song_id: str, _: str = Depends(get_current_user)):
     ref = db.reference(f"Songs/{song_id}")
-    data = ref.get()
+    data = upstream.firebase.call(ref.get)
     if not data:
         raise HTTPException(status_code=404, detail="Song not found")
-    ref.delete()
-    remove_song_from(data["playlist_id"], song_id)
+
+    playlist_id = data["playlist_id"]
+    if not upstream.db_get(f"PlaylistToSongs/{playlist_id}/{song_id}"):
+        raise HTTPException(status_code=404, detail="Song not found in mapping")
+
+    updates = {
+        f"Songs/{song_id}": None,
+        f"PlaylistToSongs/{playlist_id}/{song_id}": None,
+    }
+    updates.update(changelog.change_entry(playlist_id, changelog.SONG_REMOVED, song_id))
+    updates.update(etags.version_entry(f"PlaylistToSongs/{playlist_id}"))
+    upstream.db_update(updates)
     return {"message": f"Song {song_id} deleted successfully"}
 
 
 @router.get("/{playlist_id}/songs")
-def get_all_songs_for(playlist_id: str, _: str = Depends(get_current_user)):
-    ref = db.reference(f"PlaylistToSongs/{playlist_id}")
-    data = ref.get()
+def get_all_songs_for(
+    playlist_id: str,
+    request: Request = None,
+    response: Response = None,
+    _: str = Depends(get_current_user)
+):
+    unchanged = etags.check_collection(f"PlaylistToSongs/{playlist_id}", request, response)
+    if unchanged:
+        return unchanged
+
+    # everyone opening the same playlist at once shares one fetch
+    return cache.versioned(f"PlaylistToSongs/{playlist_id}", lambda: load_songs_for(playlist_id))
+
+
+def load_songs_for(playlist_id: str):
+    data = upstream.db_get(f"PlaylistToSongs/{playlist_id}")
     all_songs = []
 
     if data == None:
@@ -128,7 +160,9 @@ def get_youtube_client():
     api_key = os.getenv("YOUTUBE_API_KEY")
     if not api_key:
         raise ValueError("Missing YOUTUBE_API_KEY in environment variables")
-    return build("youtube", "v3", developerKey=api_key)
+    # socket timeout so calls abandoned at the deadline also free their slot soon
+    http = httplib2.Http(timeout=upstream.youtube.timeout)
+    return build("youtube", "v3", developerKey=api_key, http=http)
 
 
 def get_yt_data(url: str):
@@ -136,12 +170,15 @@ def get_yt_data(url: str):
     if not video_id:
         return {"error": "Invalid YouTube URL"}
 
-    youtube = get_youtube_client()
-    request = youtube.videos().list(
-        part="snippet,contentDetails,statistics",
-        id=video_id
-    )
-    response = request.execute()
+    def fetch():
+        youtube = get_youtube_client()
+        request = youtube.videos().list(
+            part="snippet,contentDetails,statistics",
+            id=video_id
+        )
+        return request.execute()
+
+    response = upstream.youtube.call(fetch)
     
     if not response["items"]:
         return {"error": "Video not found"}
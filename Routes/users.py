@@ -1,7 +1,14 @@
-from fastapi import APIRouter, Body, HTTPException, Depends
+from fastapi import APIRouter, Body, HTTPException, Depends, Query, Request, Response
 from Modules import User, UserUpdate
+from Routes.playlists import get_all_playlists_for
 from firebase_admin import db
 from auth import get_current_user
+import etags
+import upstream
+import singleflight
+import cache
+
+from typing import List
 
 import datetime
 
@@ -19,18 +26,38 @@ def create_user(user: User = Body(...), uid: str = Depends(get_current_user)):
     user_dict = user.model_dump()  
     user_dict["id"] = uid 
     user_dict["date_joined"] = datetime.datetime.now().isoformat()
-    ref.child(user_dict["id"]).set(user_dict)
-    return user_dict
+
+    # Friends go into the UserToFriends index both ways, never onto the user node
+    friends = [f for f in dict.fromkeys(user_dict.pop("friends")) if f != uid]
+    user_dict.pop("friends_updated", None)
+    if not friends:
+        upstream.firebase.call(ref.child(user_dict["id"]).set, user_dict)
+        return dict(user_dict, friends=friend_ids(uid))
+
+    updates = friendship_updates(uid, friends, add=True, known={uid: user_dict})
+    # the node is written whole, so its timestamp can't be a separate path of the same update
+    user_dict["friends_updated"] = updates.pop(f"Users/{uid}/friends_updated")
+    updates[f"Users/{uid}"] = user_dict
+    upstream.db_update(updates)
+    return dict(user_dict, friends=friend_ids(uid))
 
 
 @router.get("/{user_id}", response_model=User)
-def get_user(user_id: str, _: str = Depends(get_current_user)):
+def get_user(
+    user_id: str,
+    request: Request = None,
+    response: Response = None,
+    _: str = Depends(get_current_user)
+):
     ref = db.reference(f"Users/{user_id}")
-    data = ref.get()
+    data, unchanged = etags.read_entity(ref, request, response)
+    if unchanged:
+        return unchanged
 
     if not data:
         raise HTTPException(status_code=404, detail="User not found")
 
+    data["friends"] = friend_ids(user_id)
     return User(**data)
 
 
@@ -40,30 +67,33 @@ def patch_user(user_id: str, update: UserUpdate = Body(...), _: str = Depends(ge
     update_dict = update.model_dump(exclude_unset=True)
 
     ref = db.reference(f"Users/{user_id}")
-    existing = ref.get()
+    existing = upstream.firebase.call(ref.get)
     if not existing:
         raise HTTPException(status_code=404, detail="User not found")
     
-    if "friends" in update_dict and update_dict["friends"]:
-        existing_friends = existing.get("friends", [])
-        new_friends = update_dict["friends"]
-        update_dict["friends"] = list(set(existing_friends + new_friends))
+    # Friends are added through the UserToFriends index, not stored on the user
+    updates = {}
+    new_friends = [f for f in update_dict.pop("friends", []) if f != user_id]
+    if new_friends:
+        updates.update(friendship_updates(user_id, new_friends, add=True))
 
     update_dict["id"] = user_id
 
     # Update only the provided fields
-    ref.update(update_dict)
+    updates.update({f"Users/{user_id}/{key}": value for key, value in update_dict.items()})
+    upstream.db_update(updates)
 
-    updated_data = ref.get()
+    updated_data = upstream.firebase.call(ref.get)
+    updated_data["friends"] = friend_ids(user_id)
     return User(**updated_data)
 
 
 def remove_us_map(user_id: str):
     ref = db.reference(f"UserToPlaylists/{user_id}")
-    data = ref.get()
+    data = upstream.firebase.call(ref.get)
     if not data:
         raise HTTPException(status_code=404, detail="User not found in User to Playlist mapping")
-    ref.delete()
+    upstream.firebase.call(ref.delete)
 
 
 @router.delete("/{user_id}")
@@ -71,15 +101,148 @@ def delete_user(user_id: str, _: str = Depends(get_current_user)):
     ref = db.reference(f"Users/{user_id}")
 
     # Fetch the user first to see if it exists
-    data = ref.get()
+    data = upstream.firebase.call(ref.get)
 
     if not data:
         raise HTTPException(status_code=404, detail="User not found")
     
-    data = ref.delete()
+    # read before deleting, the user node may still hold a legacy friends list
+    friends = friend_ids(user_id)
+
+    # drop the user from friends' adjacency lists in the same update
+    updates = {f"Users/{user_id}": None}
+    if friends:
+        now = datetime.datetime.now().isoformat()
+        updates[f"UserToFriends/{user_id}"] = None
+        updates.update(etags.version_entry(f"UserToFriends/{user_id}"))
+        for friend_id in friends:
+            updates[f"UserToFriends/{friend_id}/{user_id}"] = None
+            updates.update(etags.version_entry(f"UserToFriends/{friend_id}"))
+            # changes the friend's node and with it the ETag of GET /user/{friend_id}
+            if upstream.db_get(f"Users/{friend_id}/id"):
+                updates[f"Users/{friend_id}/friends_updated"] = now
+    upstream.db_update(updates)
+
     return {"message": f"User {user_id} deleted successfully"}
 
 
-# add/remove friend
+# -------------------- FRIENDS --------------------
+# Friendships are stored both ways in UserToFriends/{user_id}/{friend_id}, like the other
+# mapping nodes. Users created before the index may still carry a `friends` list, which
+# is folded into the index the first time one of their friendships changes.
+
+def friend_ids(user_id: str) -> list:
+    '''Ids of user's friends, cached per user while their UserToFriends version is unchanged.'''
+    def load():
+        index = upstream.db_get(f"UserToFriends/{user_id}") or {}
+        legacy = upstream.db_get(f"Users/{user_id}/friends") or []
+        return sorted(set(index) | set(legacy))
+
+    return cache.versioned(f"UserToFriends/{user_id}", load)
+
+
+def migrate_friends(user_id: str, user_data: dict, now: str) -> dict:
+    '''Returns multi-path update entries moving a legacy `friends` list into the index.'''
+    legacy = user_data.get("friends") or []
+    if not legacy:
+        return {}
+
+    updates = {f"Users/{user_id}/friends": None}
+    for friend_id in legacy:
+        if friend_id == user_id:
+            continue
+        updates[f"UserToFriends/{user_id}/{friend_id}"] = True
+        updates[f"UserToFriends/{friend_id}/{user_id}"] = True
+        updates.update(etags.version_entry(f"UserToFriends/{friend_id}"))
+        # don't recreate a node for a friend who has deleted their account
+        if singleflight.get(f"Users/{friend_id}/id"):
+            updates[f"Users/{friend_id}/friends_updated"] = now
+    return updates
+
+
+def friendship_updates(user_id: str, friends: list, add: bool, known: dict = None) -> dict:
+    '''
+    Returns multi-path update entries adding (or removing) friendships between
+    user_id and each of friends, in both directions.
+    `known` maps user ids to node data the caller already has (e.g. a user being created).
+    Raises 404 if any of the users doesn't exist.
+    '''
+    known = known or {}
+    users = {}
+    for uid in [user_id, *friends]:
+        data = known[uid] if uid in known else upstream.db_get(f"Users/{uid}")
+        if not data:
+            raise HTTPException(status_code=404, detail=f"User {uid} not found")
+        users[uid] = data
+
+    now = datetime.datetime.now().isoformat()
+    updates = {}
+    for uid, data in users.items():
+        updates.update(migrate_friends(uid, data, now))
+
+    for friend_id in friends:
+        updates[f"UserToFriends/{user_id}/{friend_id}"] = True if add else None
+        updates[f"UserToFriends/{friend_id}/{user_id}"] = True if add else None
+
+    # friends_updated changes the user node, and with it the ETag of GET /user/{id}
+    for uid in users:
+        updates[f"Users/{uid}/friends_updated"] = now
+        updates.update(etags.version_entry(f"UserToFriends/{uid}"))
+    return updates
+
+
+@router.get("/{user_id}/friends")
+def get_friends(user_id: str, _: str = Depends(get_current_user)):
+    return friend_ids(user_id)
+
+
+@router.post("/{user_id}/friends/{friend_id}")
+def add_friend(user_id: str, friend_id: str, _: str = Depends(get_current_user)):
+    if user_id == friend_id:
+        raise HTTPException(status_code=400, detail="User can't be their own friend")
+
+    upstream.db_update(friendship_updates(user_id, [friend_id], add=True))
+    return {"message": f"Users {user_id} and {friend_id} are now friends."}
+
+
+@router.delete("/{user_id}/friends/{friend_id}")
+def remove_friend(user_id: str, friend_id: str, _: str = Depends(get_current_user)):
+    if friend_id not in friend_ids(user_id):
+        raise HTTPException(status_code=404, detail="Friend not found")
+
+    upstream.db_update(friendship_updates(user_id, [friend_id], add=False))
+    return {"message": f"Users {user_id} and {friend_id} are no longer friends."}
+
+
+@router.get("/{user_id}/friends/mutual")
+def get_mutual_friends(user_id: str, other: List[str] = Query(...), _: str = Depends(get_current_user)):
+    '''
+    Returns mutual friends of the user with each of the other users.
+
+    other: str, repeatable, ids of the users to compare with
+    '''
+    mine = set(friend_ids(user_id))
+    return {other_id: sorted(mine & set(friend_ids(other_id))) for other_id in other}
+
+
+@router.get("/{user_id}/friends/playlists")
+def get_friends_playlists(user_id: str, _: str = Depends(get_current_user)):
+    '''
+    Returns playlists the user's friends are editing and the user isn't,
+    each with the ids of the friends editing it, most recently updated first.
+    '''
+    own = set(singleflight.get(f"UserToPlaylists/{user_id}") or {})
+    feed = {}
+
+    for friend_id in friend_ids(user_id):
+        # lists are cached per friend and rebuilt only when their playlists change
+        for playlist in get_all_playlists_for(friend_id):
+            if playlist.id in own:
+                continue
+            entry = feed.setdefault(playlist.id, {"playlist": playlist, "friends": []})
+            entry["friends"].append(friend_id)
+
+    return sorted(feed.values(), key=lambda entry: entry["playlist"].last_updated or "", reverse=True)
+
 
 # add/remove editor
\ No newline at end of file
@@ -1,6 +1,8 @@
 from fastapi import Request, HTTPException, status
 from firebase_admin import auth as firebase_auth
 
+import upstream
+
 def get_current_user(request: Request) -> str:
     auth_header = request.headers.get("Authorization")
 
@@ -13,8 +15,10 @@ def get_current_user(request: Request) -> str:
     token = auth_header.split(" ")[1]
 
     try:
-        decoded_token = firebase_auth.verify_id_token(token)
+        decoded_token = upstream.token.call(firebase_auth.verify_id_token, token)
         return decoded_token["uid"]
+    except HTTPException:
+        raise       # token verification unavailable, not the client's fault
     except Exception:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -0,0 +1,188 @@
+from fastapi import HTTPException, status
+from dotenv import load_dotenv
+import os
+import queue
+import secrets
+import threading
+import time
+
+import upstream
+
+load_dotenv()
+
+# Opt-in: with WRITE_BATCHING unset every write is its own multi-path update
+ENABLED = os.getenv("WRITE_BATCHING", "").lower() in ("1", "true", "yes")
+MAX_ITEMS = int(os.getenv("WRITE_BATCH_MAX_ITEMS", "100"))
+MAX_WAIT_SECONDS = float(os.getenv("WRITE_BATCH_MAX_WAIT_MS", "5")) / 1000
+MAX_QUEUE = int(os.getenv("WRITE_BATCH_MAX_QUEUE", "1000"))
+# How long a writer may wait for room in a full queue before getting 503
+ENQUEUE_TIMEOUT_SECONDS = float(os.getenv("WRITE_BATCH_ENQUEUE_TIMEOUT_SECONDS", "1"))
+# Longest one Firebase write can take, waiting for a free slot included
+CALL_SECONDS = upstream.firebase.queue_timeout + upstream.firebase.timeout
+# Time budget of one flush, retries included; writes it doesn't get to fail with 503
+MAX_FLUSH_SECONDS = max(CALL_SECONDS, float(os.getenv("WRITE_BATCH_MAX_FLUSH_SECONDS", str(2 * CALL_SECONDS))))
+# Worst case from commit() until the write has landed or is known to never land
+MAX_COMMIT_SECONDS = (
+    ENQUEUE_TIMEOUT_SECONDS + MAX_WAIT_SECONDS + 2 * MAX_FLUSH_SECONDS if ENABLED else CALL_SECONDS
+)
+
+
+# -------------------- Push keys --------------------
+
+PUSH_CHARS = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+
+_key_lock = threading.Lock()
+_last_push_ms = 0
+_last_rand = [0] * 12
+
+
+def new_key() -> str:
+    '''
+    Generates a Firebase style push key locally: 8 chars of timestamp + 12 random chars.
+    Keys sort in creation order like the ones from ref.push(), without the round trip.
+    '''
+    global _last_push_ms
+    with _key_lock:
+        now = int(time.time() * 1000)
+        if now == _last_push_ms:
+            # same millisecond: increment the random part so keys stay unique and ordered
+            i = 11
+            while i >= 0 and _last_rand[i] == 63:
+                _last_rand[i] = 0
+                i -= 1
+            if i >= 0:
+                _last_rand[i] += 1
+        else:
+            for i in range(12):
+                _last_rand[i] = secrets.randbelow(64)
+        _last_push_ms = now
+
+        ts_chars = []
+        for _ in range(8):
+            ts_chars.append(PUSH_CHARS[now % 64])
+            now //= 64
+        return "".join(reversed(ts_chars)) + "".join(PUSH_CHARS[r] for r in _last_rand)
+
+
+# -------------------- Group commit --------------------
+
+QUEUED, FLUSHING, ABANDONED = "queued", "flushing", "abandoned"
+
+
+class _Pending:
+    def __init__(self, updates: dict):
+        self.updates = updates
+        self.done = threading.Event()
+        self.error = None
+        self.state = QUEUED
+
+
+_queue = queue.Queue(maxsize=MAX_QUEUE)
+_state_lock = threading.Lock()     # guards _Pending.state between writers and the flusher
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+
+
+def _ensure_flusher():
+    '''Starts the flusher thread in this process (again after a fork).'''
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    with _flusher_lock:
+        if _flusher_pid != os.getpid():
+            threading.Thread(target=_flush_loop, name="write-batcher", daemon=True).start()
+            _flusher_pid = os.getpid()
+
+
+def _flush_loop():
+    while True:
+        batch = [_queue.get()]
+        deadline = time.monotonic() + MAX_WAIT_SECONDS
+        while len(batch) < MAX_ITEMS:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        # writers that gave up already got an error, their writes must not land
+        with _state_lock:
+            batch = [pending for pending in batch if pending.state == QUEUED]
+            for pending in batch:
+                pending.state = FLUSHING
+        if batch:
+            _flush(batch, time.monotonic() + MAX_FLUSH_SECONDS)
+
+
+def _fail(batch: list, error: Exception):
+    for pending in batch:
+        pending.error = error
+        pending.done.set()
+
+
+def _flush(batch: list, deadline: float):
+    # a write is only started if it ends before the deadline, so commit() can bound its wait
+    if time.monotonic() + CALL_SECONDS > deadline:
+        return _fail(batch, upstream.unavailable("Write was not committed, try again later"))
+
+    merged = {}
+    for pending in batch:
+        merged.update(pending.updates)
+
+    try:
+        upstream.db_update(merged)
+    except Exception as e:
+        if len(batch) > 1 and upstream.is_client_error(e):
+            # one writer's bad path makes Firebase reject the whole update; bisect
+            # so only that writer gets the error, in a few round trips rather than one per writer
+            middle = len(batch) // 2
+            _flush(batch[:middle], deadline)
+            _flush(batch[middle:], deadline)
+            return
+        return _fail(batch, e)
+
+    for pending in batch:
+        pending.done.set()
+
+
+def commit(updates: dict):
+    '''
+    Writes a multi-path update. With batching enabled, updates arriving within
+    MAX_WAIT_SECONDS (or up to MAX_ITEMS of them) are merged into one update, and
+    this call returns once the batch holding it is committed.
+    Paths of concurrent updates must not overlap, e.g. creations of new entities.
+    '''
+    if not ENABLED:
+        return upstream.db_update(updates)
+
+    _ensure_flusher()
+    pending = _Pending(updates)
+    try:
+        _queue.put(pending, timeout=ENQUEUE_TIMEOUT_SECONDS)
+    except queue.Full:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many pending writes, try again later",
+            headers={"Retry-After": "1"}
+        )
+
+    # the flush running when we were queued ends within MAX_FLUSH_SECONDS, then ours starts
+    if not pending.done.wait(MAX_WAIT_SECONDS + MAX_FLUSH_SECONDS):
+        with _state_lock:
+            abandoned = pending.state == QUEUED
+            if abandoned:
+                pending.state = ABANDONED
+        if abandoned:
+            # still queued: the flusher will drop it, so a retry can't duplicate it
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Write was not committed, try again later",
+                headers={"Retry-After": "1"}
+            )
+        # already being flushed, which ends within MAX_FLUSH_SECONDS
+        if not pending.done.wait(MAX_FLUSH_SECONDS):
+            raise upstream.unavailable("Write did not finish in time, try again later")
+    if pending.error is not None:
+        raise pending.error
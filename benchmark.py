@@ -0,0 +1,107 @@
+'''
+Measures request throughput of the API for different worker counts.
+
+    python benchmark.py --playlist <playlist_id> --token <firebase id token> --workers 1 2 4
+    python benchmark.py --path /playlist/<playlist_id> --token <firebase id token>
+
+By default it reads the song list of a playlist, which goes through token
+verification, the per-worker list cache and Firebase. Each run starts
+`uvicorn main:app --workers N` on a free local port, waits until it answers, fires
+the requests from a thread pool and prints requests per second. Requests shed with
+503 by admission control are counted separately and are not part of the throughput.
+Throughput should grow close to linearly with N until the machine runs out of cores.
+'''
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+
+def max_in_flight():
+    return int(os.getenv("MAX_IN_FLIGHT_REQUESTS", "32"))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    raise RuntimeError(f"Server at {url} did not come up")
+
+
+def run(workers: int, path: str, total: int, concurrency: int, token: str = None):
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host=127.0.0.1",
+         f"--port={port}", f"--workers={workers}", "--log-level=warning"],
+    )
+    try:
+        base = f"http://127.0.0.1:{port}"
+        wait_until_up(base + "/")
+
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+
+        def one(_):
+            req = urllib.request.Request(base + path, headers=headers)
+            try:
+                urllib.request.urlopen(req, timeout=30).read()
+                return "ok"
+            except urllib.error.HTTPError as e:
+                return "shed" if e.code == 503 else "failed"
+            except urllib.error.URLError:
+                return "failed"
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            outcomes = list(pool.map(one, range(total)))
+        elapsed = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+
+    return {o: outcomes.count(o) for o in ("ok", "shed", "failed")}, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--playlist", help="playlist whose song list is requested")
+    parser.add_argument("--path", help="request this path instead of the playlist song list")
+    parser.add_argument("--token", help="Firebase id token sent as Bearer token")
+    parser.add_argument("--requests", type=int, default=5000)
+    # at MAX_IN_FLIGHT_REQUESTS so a single worker isn't measured while shedding
+    parser.add_argument("--concurrency", type=int, default=max_in_flight())
+    args = parser.parse_args()
+
+    if args.path is None:
+        if not args.playlist:
+            parser.error("either --playlist or --path is required")
+        args.path = f"/song/{args.playlist}/songs"
+
+    baseline = None
+    for workers in args.workers:
+        counts, elapsed = run(workers, args.path, args.requests, args.concurrency, args.token)
+        rps = counts["ok"] / elapsed
+        if baseline is None and rps > 0:
+            baseline = rps
+        scale = f"x{rps / baseline:.2f}" if baseline else "n/a"
+        print(f"workers={workers:<3} ok={counts['ok']}/{args.requests} shed={counts['shed']} "
+              f"failed={counts['failed']} {rps:9.1f} req/s  {scale}")
+
+
+if __name__ == "__main__":
+    main()
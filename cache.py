@@ -0,0 +1,56 @@
+from dotenv import load_dotenv
+from collections import OrderedDict
+import copy
+import os
+import threading
+
+import singleflight
+import upstream
+
+load_dotenv()
+
+MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+
+# Per-worker LRU of composite collection lists, keyed by mapping path and tagged with
+# the Versions/<mapping path> stamp they were built from. Every write replaces the
+# stamp in the database, so each worker notices on its next read and rebuilds the list.
+# The database is the invalidation bus: no worker ever serves a list older than the
+# stamp it just read, however many workers there are.
+_entries = OrderedDict()    # mapping_path -> (version, result)
+_lock = threading.Lock()
+
+
+def versioned(mapping_path: str, loader):
+    '''
+    Returns loader() for the collection at mapping_path, reusing this worker's copy
+    while the collection version stamp is unchanged. Concurrent misses share one load.
+    '''
+    # not coalesced: joining a stamp read that started before our own write would
+    # serve the pre-write list; the stamp is one small node, the list load is shared below
+    version = upstream.db_get(f"Versions/{mapping_path}")
+
+    if version is not None:
+        with _lock:
+            hit = _entries.get(mapping_path)
+            if hit and hit[0] == version:
+                _entries.move_to_end(mapping_path)
+                return copy.deepcopy(hit[1])
+
+    # a load that started before the stamp we read may predate the write behind it,
+    # so only loads started for this very version are shared
+    result = singleflight.do(f"list:{mapping_path}:{version}", loader)
+
+    # collections with no stamp yet (never written since versioning) are not cached
+    if version is not None:
+        with _lock:
+            _entries[mapping_path] = (version, copy.deepcopy(result))
+            _entries.move_to_end(mapping_path)
+            while len(_entries) > MAX_ENTRIES:
+                _entries.popitem(last=False)
+
+    return result
+
+
+def clear():
+    with _lock:
+        _entries.clear()
@@ -0,0 +1,144 @@
+from fastapi import HTTPException
+from firebase_admin import db
+from dotenv import load_dotenv
+import datetime
+import os
+import re
+import time
+import uuid
+
+import batcher
+import singleflight
+import upstream
+
+load_dotenv()
+
+# How long entries stay in PlaylistChanges before being compacted away.
+# Clients holding an older cursor are told to do a full refresh instead.
+RETENTION_HOURS = float(os.getenv("CHANGE_LOG_RETENTION_HOURS", "72"))
+MAX_CHANGES_PER_PAGE = 500
+# A change gets its cursor when the update is built, not when it commits. A commit lands
+# or is dropped within batcher.MAX_COMMIT_SECONDS, so anything keyed older than this lag
+# has either landed or failed, and cursors never move past it.
+SAFETY_LAG_SECONDS = max(
+    float(os.getenv("CHANGE_LOG_SAFETY_LAG_SECONDS", "15")),
+    batcher.MAX_COMMIT_SECONDS + 1
+)
+COMPACT_EVERY_SECONDS = 3600
+
+# Cursors handed out: new_cursor() keys, or a bare 20 digit timestamp (the horizon)
+CURSOR_PATTERN = re.compile(r"[0-9]{20}(-[0-9a-f]{8})?")
+
+_last_compacted = {}    # playlist_id -> monotonic time of the last compaction
+
+SONG_ADDED = "song_added"
+SONG_REMOVED = "song_removed"
+COMMENT_ADDED = "comment_added"
+COMMENT_EDITED = "comment_edited"
+COMMENT_DELETED = "comment_deleted"
+REACTION_ADDED = "reaction_added"
+REACTION_REMOVED = "reaction_removed"
+EDITOR_ADDED = "editor_added"
+
+
+def new_cursor(ts_ns: int = None) -> str:
+    '''Returns a lexicographically sortable key: zero padded nanoseconds + random suffix.
+    Sorting keys gives the order in which changes were written.'''
+    if ts_ns is None:
+        ts_ns = time.time_ns()
+    return f"{ts_ns:020d}-{uuid.uuid4().hex[:8]}"
+
+
+def change_entry(playlist_id: str, kind: str, entity_id: str, data: dict = None) -> dict:
+    '''
+    Returns the {path: value} pair that appends one change to the playlist change log.
+    Meant to be merged into the multi-path update that performs the change itself,
+    so the entity and its log entry are written atomically.
+    '''
+    entry = {
+        "kind": kind,
+        "id": entity_id,
+        "at": datetime.datetime.now().isoformat(),
+    }
+    if data is not None:
+        entry["data"] = data
+    return {f"PlaylistChanges/{playlist_id}/{new_cursor()}": entry}
+
+
+def retention_cutoff() -> str:
+    '''Cursor of the oldest entry still guaranteed to be in the log.'''
+    cutoff_ns = time.time_ns() - int(RETENTION_HOURS * 3600 * 1e9)
+    return f"{cutoff_ns:020d}"
+
+
+def safe_horizon() -> str:
+    '''Cursor below which no change can still be in flight.'''
+    horizon_ns = time.time_ns() - int(SAFETY_LAG_SECONDS * 1e9)
+    return f"{horizon_ns:020d}"
+
+
+def compact_changes(playlist_id: str):
+    '''Drops change log entries older than the retention window.'''
+    _last_compacted[playlist_id] = time.monotonic()
+    ref = db.reference(f"PlaylistChanges/{playlist_id}")
+    expired = upstream.firebase.call(ref.order_by_key().end_at(retention_cutoff()).get)
+    if not expired:
+        return 0
+    upstream.firebase.call(ref.update, {key: None for key in expired})
+    return len(expired)
+
+
+def maybe_compact(playlist_id: str):
+    '''Compacts the log at most once per COMPACT_EVERY_SECONDS for a given playlist.'''
+    last = _last_compacted.get(playlist_id)
+    if last is None or time.monotonic() - last > COMPACT_EVERY_SECONDS:
+        compact_changes(playlist_id)
+
+
+def get_changes_since(playlist_id: str, since: str = None) -> dict:
+    '''
+    Returns the deltas written after the `since` cursor, up to the safe horizon.
+    `reset` is True when the cursor is missing, older than the retention window or
+    from the future, in which case the client has to refetch the playlist in full.
+    Raises 400 for anything that isn't a cursor.
+
+    Changes from the last SAFETY_LAG_SECONDS are held back until no earlier write can
+    still land, so a returned cursor never skips a change. Without new changes the cursor
+    still moves up to the horizon, so idle playlists never fall behind the retention window.
+    '''
+    ref = db.reference(f"PlaylistChanges/{playlist_id}")
+    horizon = safe_horizon()
+
+    if since and not CURSOR_PATTERN.fullmatch(since):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    # a cursor from the future would sit above the horizon, and so never move again
+    if not since or since < retention_cutoff() or since[:20] > f"{time.time_ns():020d}":
+        # the full refetch already contains anything between the horizon and now,
+        # replaying those deltas afterwards is harmless
+        return {"changes": [], "cursor": horizon, "reset": True, "has_more": False}
+
+    if since >= horizon:
+        return {"changes": [], "cursor": since, "reset": False, "has_more": False}
+
+    # start_at is inclusive, so ask for one extra entry and drop the cursor itself
+    query = ref.order_by_key().start_at(since).end_at(horizon)
+    data = upstream.firebase.call(query.limit_to_first(MAX_CHANGES_PER_PAGE + 1).get) or {}
+    changes = [dict(entry, cursor=key) for key, entry in sorted(data.items()) if key != since]
+    has_more = len(changes) > MAX_CHANGES_PER_PAGE
+    changes = changes[:MAX_CHANGES_PER_PAGE]
+    cursor = changes[-1]["cursor"] if has_more else horizon
+
+    return {"changes": changes, "cursor": cursor, "reset": False, "has_more": has_more}
+
+
+def playlist_of_song(song_id: str):
+    return singleflight.get(f"Songs/{song_id}/playlist_id")
+
+
+def playlist_of_comment(comment_id: str = None, song_id: str = None):
+    if song_id is None:
+        song_id = singleflight.get(f"Comments/{comment_id}/song_id")
+    if not song_id:
+        return None
+    return playlist_of_song(song_id)
@@ -0,0 +1,82 @@
+from fastapi import Request, Response
+import upstream
+import uuid
+
+# Collections (mapping nodes such as PlaylistToSongs/{id}) get a version stamp under
+# Versions/<mapping path>. Every write that changes the collection or one of its
+# entities replaces the stamp in the same multi-path update, so the stamp alone is
+# enough to answer If-None-Match without reading the collection.
+
+
+def version_entry(mapping_path: str) -> dict:
+    '''Returns the multi-path update entry that bumps version of a collection.'''
+    return {f"Versions/{mapping_path}": uuid.uuid4().hex}
+
+
+def if_none_match(request: Request):
+    '''Returns the first entity tag sent in If-None-Match, without quotes, or None.'''
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return None
+    tag = header.split(",")[0].strip()
+    if tag.startswith("W/"):
+        tag = tag[2:]
+    return tag.strip('"') or None
+
+
+def etag_header(tag: str) -> str:
+    '''
+    Formats a tag for the ETag header. Tags are weak: GZipMiddleware may compress the
+    body, and a strong tag would have to differ between the plain and gzipped bytes.
+    '''
+    return f'W/"{tag}"'
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag_header(etag)})
+
+
+def read_entity(ref, request: Request = None, response: Response = None):
+    '''
+    Reads a single entity node using Firebase ETags.
+    Returns (data, None), or (None, 304 response) when the client copy is still current.
+    Without a request (internal calls) it is a plain read. It is not coalesced on its
+    own: list loads already are, and joining an older in-flight read there could put
+    pre-write data into a list cached under the post-write version.
+    '''
+    if request is None:
+        return upstream.firebase.call(ref.get), None
+
+    client_etag = if_none_match(request)
+    if client_etag:
+        changed, data, etag = upstream.firebase.call(ref.get_if_changed, client_etag)
+        if not changed:
+            return None, not_modified(etag)
+    else:
+        data, etag = upstream.firebase.call(ref.get, etag=True)
+
+    if data and response is not None:
+        response.headers["ETag"] = etag_header(etag)
+    return data, None
+
+
+def check_collection(mapping_path: str, request: Request = None, response: Response = None):
+    '''
+    Compares collection version stamp with If-None-Match.
+    Returns 304 response when it matches, otherwise sets ETag on the response and returns None.
+    Collections that were never written since versioning was added have no ETag.
+    '''
+    if request is None:
+        return None
+
+    # read directly: a coalesced read may predate the client's own write
+    version = upstream.db_get(f"Versions/{mapping_path}")
+    if version is None:
+        return None
+
+    if if_none_match(request) == version:
+        return not_modified(version)
+
+    if response is not None:
+        response.headers["ETag"] = etag_header(version)
+    return None
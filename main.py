@@ -1,11 +1,16 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
 import firebase_admin
 import json
 from firebase_admin import credentials
 from dotenv import load_dotenv
+from contextlib import asynccontextmanager
 import os
 
 from Routes import songs, playlists, users, comments, reactions
+import cache
+import upstream
 
 load_dotenv()
 
@@ -23,17 +28,64 @@ elif os.path.exists("serviceAccountKey.json"):
 else:
     raise RuntimeError("Firebase credentials not found")
 
-if not firebase_admin._apps:
+_firebase_pid = None     # process that owns the current default app
+
+def init_firebase():
+    '''
+    Initializes the default Firebase app for the current process.
+    A worker forked from a process that already initialized it (e.g. gunicorn --preload)
+    inherits the parent's app and its open HTTP connections, so it gets a fresh one.
+    '''
+    global _firebase_pid
+    if firebase_admin._apps:
+        if _firebase_pid == os.getpid():
+            return
+        firebase_admin.delete_app(firebase_admin.get_app())
+
     firebase_admin.initialize_app(cred, {
-        "databaseURL": database_url
+        "databaseURL": database_url,
+        "httpTimeout": upstream.firebase.timeout
     })
+    _firebase_pid = os.getpid()
+
+init_firebase()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # runs in every worker process once it is up
+    init_firebase()
+    cache.clear()
+    yield
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+# Compress JSON bodies above the threshold (bytes) for clients sending Accept-Encoding: gzip
+app.add_middleware(GZipMiddleware, minimum_size=int(os.getenv("GZIP_MIN_SIZE", "1000")))
+
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    # shed load before the threadpool saturates and every request slows down
+    if request.url.path == "/status":
+        return await call_next(request)
+    if not upstream.admit_request():
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "Server is busy, try again later"},
+            headers={"Retry-After": "1"}
+        )
+    try:
+        return await call_next(request)
+    finally:
+        upstream.finish_request()
 
 @app.get("/")
 def home():
     return {"message": "Welcome to SharedPlay API"}
 
+@app.get("/status")
+def upstream_status():
+    return upstream.stats()
+
 app.include_router(users.router)
 app.include_router(playlists.router)
 app.include_router(songs.router)
@@ -43,5 +95,10 @@ app.include_router(reactions.router)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+    )
         
\ No newline at end of file
@@ -0,0 +1,71 @@
+from fastapi import HTTPException, status
+from dotenv import load_dotenv
+import copy
+import os
+import threading
+
+import upstream
+
+load_dotenv()
+
+# How long a request waits for someone else's in-flight fetch before giving up
+WAIT_TIMEOUT_SECONDS = float(os.getenv("SINGLEFLIGHT_TIMEOUT_SECONDS", "10"))
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+_calls = {}             # key -> _Call currently in flight
+_lock = threading.Lock()
+
+
+def do(key: str, fn, timeout: float = None):
+    '''
+    Runs fn() once for all concurrent callers using the same key.
+    The first caller fetches, everyone arriving while it runs waits and gets a copy
+    of the same result (or the same exception). At most one fetch per key is in flight.
+    '''
+    with _lock:
+        call = _calls.get(key)
+        leader = call is None
+        if leader:
+            call = _Call()
+            _calls[key] = call
+        else:
+            call.waiters += 1
+
+    if leader:
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+        finally:
+            # nobody can join once the call is popped, so the waiter count is final
+            with _lock:
+                _calls.pop(key, None)
+                shared = call.waiters > 0
+            call.done.set()
+        if call.error is not None:
+            raise call.error
+        # the leader mutates its result too, so it must not hand out the one waiters copy from
+        return copy.deepcopy(call.result) if shared else call.result
+
+    if not call.done.wait(WAIT_TIMEOUT_SECONDS if timeout is None else timeout):
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail=f"Timed out waiting for {key}"
+        )
+    if call.error is not None:
+        raise call.error
+    # callers mutate what they get back (ids, comment depth), so waiters get their own copy
+    return copy.deepcopy(call.result)
+
+
+def get(path: str, timeout: float = None):
+    '''Coalesced db.reference(path).get().'''
+    return do(f"db:{path}", lambda: upstream.db_get(path), timeout)
@@ -0,0 +1,224 @@
+from firebase_admin import db
+from dotenv import load_dotenv
+import datetime
+import json
+import os
+
+from Modules import Playlist, Song, Comment, Reaction
+import batcher
+import etags
+import upstream
+
+load_dotenv()
+
+PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "100"))
+# Max number of paths written by one multi-path update during import
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "500"))
+
+# -------------------- Export --------------------
+# A playlist export is NDJSON, one {"type": ..., "data": ...} record per line:
+# the playlist first, then every song followed by its comments, each followed by its reactions,
+# and last an "end" record with the number of each. A stream cut short has no end record.
+
+
+def iter_keys(path: str, page_size: int = PAGE_SIZE):
+    '''Yields child keys of a mapping node page by page, never holding more than one page.'''
+    start = None
+    while True:
+        query = db.reference(path).order_by_key()
+        if start is not None:
+            query = query.start_at(start)
+        page = upstream.firebase.call(query.limit_to_first(page_size + 1).get) or {}
+
+        # start_at is inclusive, the first key was the last one of the previous page
+        keys = [key for key in sorted(page) if key != start]
+        yield from keys
+
+        if len(page) <= page_size or not keys:
+            return
+        start = keys[-1]
+
+
+def iter_entities(mapping_path: str, entity_path: str):
+    '''Yields (id, data) for entities listed in a mapping node, skipping dangling ids.'''
+    for entity_id in iter_keys(mapping_path):
+        data = upstream.db_get(f"{entity_path}/{entity_id}")
+        if data:
+            data["id"] = entity_id
+            yield entity_id, data
+
+
+def export_records(playlist_id: str, playlist: dict):
+    counts = {"song": 0, "comment": 0, "reaction": 0}
+    yield {"type": "playlist", "data": playlist}
+    for song_id, song in iter_entities(f"PlaylistToSongs/{playlist_id}", "Songs"):
+        counts["song"] += 1
+        yield {"type": "song", "data": song}
+        for comment_id, comment in iter_entities(f"SongToComments/{song_id}", "Comments"):
+            counts["comment"] += 1
+            yield {"type": "comment", "data": comment}
+            for _, reaction in iter_entities(f"CommentToReactions/{comment_id}", "Reactions"):
+                counts["reaction"] += 1
+                yield {"type": "reaction", "data": reaction}
+    yield {"type": "end", "data": counts}
+
+
+def export_ndjson(playlist_id: str, playlist: dict):
+    for record in export_records(playlist_id, playlist):
+        yield json.dumps(record) + "\n"
+
+
+# -------------------- Import --------------------
+
+class PlaylistImporter:
+    '''
+    Rebuilds an exported playlist under new ids, owned by `owner`.
+    Records are added one at a time; once `ready()` the pending writes should be
+    flushed, so memory stays bounded by IMPORT_BATCH_SIZE plus the id map.
+    The playlist node itself is written by `finish()`, and only once the end record
+    arrived, so a half-finished import never shows up in anyone's playlists.
+    If the import fails, `abort()` deletes what earlier flushes already wrote.
+    '''
+
+    def __init__(self, owner: str, name: str = None):
+        self.owner = owner
+        self.name = name
+        self.playlist_id = None
+        self.playlist = None
+        self.id_map = {}
+        self.updates = {}
+        self.counts = {"song": 0, "comment": 0, "reaction": 0}
+        self.imported = {"song": set(), "comment": set()}     # old ids seen so far
+        self.flushed = []       # paths already written, deleted again by abort()
+        self.complete = False
+
+    def _new_id(self, old_id):
+        # ids can be referenced before their record arrives (a reply before its parent)
+        if old_id is None:
+            return None
+        if old_id not in self.id_map:
+            self.id_map[old_id] = batcher.new_key()
+        return self.id_map[old_id]
+
+    @staticmethod
+    def _ref(data: dict, field: str):
+        '''Returns an id referenced by the record, which must be a string or missing.'''
+        value = data.get(field)
+        if value is not None and not isinstance(value, str):
+            raise ValueError(f"{field} must be a string")
+        return value
+
+    def add(self, record: dict):
+        '''
+        Validates one record against its model and queues its writes.
+        Raises ValueError (pydantic's ValidationError included) for anything malformed.
+        '''
+        if not isinstance(record, dict) or not isinstance(record.get("data"), dict):
+            raise ValueError("Every line must be an object with a \"data\" object")
+        kind, data = record.get("type"), dict(record["data"])
+
+        if self.complete:
+            raise ValueError("Records after the end record")
+
+        if kind == "end":
+            if self.playlist is None:
+                raise ValueError("Export must start with a playlist record")
+            if data != self.counts:
+                raise ValueError(f"Export announces {data} records but contains {self.counts}")
+            self.complete = True
+            return
+
+        if kind == "playlist":
+            if self.playlist is not None:
+                raise ValueError("Export contains more than one playlist")
+            self.playlist_id = batcher.new_key()
+            now = datetime.datetime.now().isoformat()
+            data.update({
+                "id": self.playlist_id,
+                "name": self.name or data.get("name"),
+                "owner": self.owner,
+                "editors": [self.owner],
+                "date_created": now,
+                "last_updated": now,
+            })
+            self.playlist = Playlist(**data).model_dump()
+            return
+
+        if self.playlist is None:
+            raise ValueError("Export must start with a playlist record")
+
+        if kind not in ("song", "comment", "reaction"):
+            raise ValueError(f"Unknown record type: {kind}")
+        if self._ref(data, "id") is None:
+            raise ValueError(f"{kind} record without an id")
+
+        if kind == "song":
+            old_id = data["id"]
+            song_id = self._new_id(old_id)
+            data.update({"id": song_id, "playlist_id": self.playlist_id})
+            song = Song(**data).model_dump()
+            self.updates[f"Songs/{song_id}"] = song
+            self.updates[f"PlaylistToSongs/{self.playlist_id}/{song_id}"] = True
+            self.imported["song"].add(old_id)
+        elif kind == "comment":
+            old_id = data["id"]
+            if self._ref(data, "song_id") not in self.imported["song"]:
+                raise ValueError(f"Comment {old_id} refers to a song that isn't in the export")
+            comment_id = self._new_id(old_id)
+            song_id = self._new_id(data["song_id"])
+            data.update({"id": comment_id, "song_id": song_id, "prev": self._new_id(self._ref(data, "prev"))})
+            comment = Comment(**data).model_dump()
+            self.updates[f"Comments/{comment_id}"] = comment
+            self.updates[f"SongToComments/{song_id}/{comment_id}"] = True
+            self.imported["comment"].add(old_id)
+        elif kind == "reaction":
+            if self._ref(data, "comment_id") not in self.imported["comment"]:
+                raise ValueError(f"Reaction {data['id']} refers to a comment that isn't in the export")
+            reaction_id = self._new_id(data["id"])
+            comment_id = self._new_id(data["comment_id"])
+            data.update({"id": reaction_id, "comment_id": comment_id})
+            reaction = Reaction(**data).model_dump()
+            self.updates[f"Reactions/{reaction_id}"] = reaction
+            self.updates[f"CommentToReactions/{comment_id}/{reaction_id}"] = True
+
+        self.counts[kind] += 1
+
+    def ready(self) -> bool:
+        return len(self.updates) >= IMPORT_BATCH_SIZE
+
+    def flush(self):
+        if self.updates:
+            upstream.db_update(self.updates)
+            self.flushed.extend(self.updates)
+            self.updates = {}
+
+    def abort(self):
+        '''Deletes everything earlier flushes wrote, after the import failed.'''
+        self.updates = {}
+        paths, self.flushed = self.flushed, []
+        for i in range(0, len(paths), IMPORT_BATCH_SIZE):
+            upstream.db_update({path: None for path in paths[i:i + IMPORT_BATCH_SIZE]})
+
+    def finish(self) -> dict:
+        if self.playlist is None:
+            raise ValueError("Export contains no playlist")
+        if not self.complete:
+            raise ValueError("Export is incomplete, the end record is missing")
+        self.updates[f"Playlists/{self.playlist_id}"] = self.playlist
+        self.updates[f"UserToPlaylists/{self.owner}/{self.playlist_id}"] = True
+        self.updates.update(etags.version_entry(f"UserToPlaylists/{self.owner}"))
+        self.flush()
+        return {"playlist": self.playlist, **self.counts}
+
+
+async def ndjson_lines(chunks):
+    '''Splits an async stream of byte chunks into non-empty lines.'''
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    if buffer.strip():
+        yield buffer
@@ -0,0 +1,223 @@
+from fastapi import HTTPException, status
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from firebase_admin import db, auth as firebase_auth
+from dotenv import load_dotenv
+import os
+import threading
+import time
+
+load_dotenv()
+
+
+def _env(name: str, default: str) -> float:
+    return float(os.getenv(name, default))
+
+
+def unavailable(detail: str, retry_after: float = 1) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail=detail,
+        headers={"Retry-After": str(max(1, int(retry_after)))}
+    )
+
+
+def is_client_error(e: Exception) -> bool:
+    '''
+    True for errors caused by the request rather than the upstream: bad arguments
+    rejected locally (e.g. a forbidden character in a db path) and 4xx answers from
+    Firebase or Google APIs. These say nothing about the upstream's health.
+    '''
+    if isinstance(e, (ValueError, TypeError)):
+        return True
+    status_code = getattr(getattr(e, "http_response", None), "status_code", None)     # FirebaseError
+    if status_code is None:
+        status_code = getattr(getattr(e, "resp", None), "status", None)              # googleapiclient HttpError
+    try:
+        return status_code is not None and 400 <= int(status_code) < 500
+    except (TypeError, ValueError):
+        return False
+
+
+class Upstream:
+    '''
+    Guards calls to one upstream service (Firebase DB, YouTube, token verification):
+      - at most `max_concurrent` calls in flight, extra callers wait `queue_timeout` then get 503
+      - every call has a deadline of `timeout` seconds, after which the caller gets 503
+      - after `failure_threshold` consecutive failures the circuit opens and calls fail fast
+        with 503 for `reset_after` seconds, then a single trial call decides whether it closes
+
+    Only timeouts, transport errors and 5xx answers count as failures. Client errors
+    (see is_client_error) and exceptions listed in `ignore` (e.g. an invalid token) are
+    re-raised without counting either way.
+    '''
+
+    def __init__(self, name, max_concurrent, timeout, queue_timeout=0.5,
+                 failure_threshold=5, reset_after=30, ignore=()):
+        self.name = name
+        self.max_concurrent = int(max_concurrent)
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.failure_threshold = int(failure_threshold)
+        self.reset_after = reset_after
+        self.ignore = tuple(ignore)
+
+        self._slots = threading.BoundedSemaphore(self.max_concurrent)
+        self._pool = ThreadPoolExecutor(max_workers=self.max_concurrent, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._in_flight = 0
+        self._counters = {"calls": 0, "rejected": 0, "short_circuited": 0, "timeouts": 0, "errors": 0, "client_errors": 0}
+
+    # ---- circuit breaker ----
+
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at < self.reset_after:
+            return "open"
+        return "half_open"
+
+    def _admit(self):
+        with self._lock:
+            state = self.state()
+            if state == "closed":
+                return False
+            if state == "half_open" and not self._trial_running:
+                self._trial_running = True
+                return True
+            self._counters["short_circuited"] += 1
+            retry_after = self.reset_after - (time.monotonic() - self._opened_at)
+        raise unavailable(f"{self.name} is unavailable, try again later", retry_after)
+
+    def _record(self, ok, trial: bool, counter: str = None):
+        '''ok is True for a success, False for a failure and None for a neutral outcome.'''
+        with self._lock:
+            if counter:
+                self._counters[counter] += 1
+            if trial:
+                self._trial_running = False
+            if ok is None:
+                return
+            if ok:
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if trial or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+    # ---- calls ----
+
+    def _release(self, _future=None):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def call(self, fn, *args, **kwargs):
+        trial = self._admit()
+
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                self._counters["rejected"] += 1
+                if trial:
+                    self._trial_running = False
+            raise unavailable(f"{self.name} is busy, try again later")
+
+        with self._lock:
+            self._in_flight += 1
+            self._counters["calls"] += 1
+
+        try:
+            future = self._pool.submit(fn, *args, **kwargs)
+        except Exception:
+            self._release()
+            raise
+        # the slot stays taken until the call really finishes, even if the caller gave up on it
+        future.add_done_callback(self._release)
+
+        try:
+            result = future.result(timeout=self.timeout)
+        except FutureTimeout:
+            self._record(False, trial, "timeouts")
+            raise unavailable(f"{self.name} did not respond in {self.timeout}s")
+        except Exception as e:
+            if isinstance(e, self.ignore) or is_client_error(e):
+                self._record(None, trial, "client_errors")
+            else:
+                self._record(False, trial, "errors")
+            raise
+
+        self._record(True, trial)
+        return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state(),
+                "in_flight": self._in_flight,
+                "max_concurrent": self.max_concurrent,
+                "timeout": self.timeout,
+                "consecutive_failures": self._failures,
+                **self._counters,
+            }
+
+
+def _upstream(name: str, prefix: str, max_concurrent: str, timeout: str, ignore=()):
+    return Upstream(
+        name,
+        max_concurrent=_env(f"{prefix}_MAX_CONCURRENT", max_concurrent),
+        timeout=_env(f"{prefix}_TIMEOUT_SECONDS", timeout),
+        queue_timeout=_env(f"{prefix}_QUEUE_TIMEOUT_SECONDS", "0.5"),
+        failure_threshold=_env(f"{prefix}_FAILURE_THRESHOLD", "5"),
+        reset_after=_env(f"{prefix}_RESET_SECONDS", "30"),
+        ignore=ignore,
+    )
+
+
+firebase = _upstream("firebase", "FIREBASE", "32", "5")
+youtube = _upstream("youtube", "YOUTUBE", "8", "5")
+# invalid or expired tokens are client errors, not a sign of a degraded upstream
+token = _upstream("token verification", "TOKEN", "16", "3", ignore=(firebase_auth.InvalidIdTokenError, ValueError))
+
+
+def db_get(path: str):
+    return firebase.call(lambda: db.reference(path).get())
+
+
+def db_update(updates: dict):
+    '''Applies a multi-path update at the database root.'''
+    return firebase.call(lambda: db.reference().update(updates))
+
+
+# -------------------- Admission control --------------------
+
+# Requests beyond this many in flight are shed with 503 before they take a thread
+MAX_IN_FLIGHT = int(_env("MAX_IN_FLIGHT_REQUESTS", "32"))
+
+_admission = {"in_flight": 0, "shed": 0}
+_admission_lock = threading.Lock()
+
+
+def admit_request() -> bool:
+    with _admission_lock:
+        if _admission["in_flight"] >= MAX_IN_FLIGHT:
+            _admission["shed"] += 1
+            return False
+        _admission["in_flight"] += 1
+        return True
+
+
+def finish_request():
+    with _admission_lock:
+        _admission["in_flight"] -= 1
+
+
+def stats() -> dict:
+    with _admission_lock:
+        admission = dict(_admission, max_in_flight=MAX_IN_FLIGHT)
+    return {
+        "admission": admission,
+        "upstreams": {u.name: u.stats() for u in (firebase, youtube, token)},
+    }